@@ -1,9 +1,12 @@
 import random
-import pickle
 import sys
 import numpy as np
 import copy
 import tic_tac_toe_environment
+import tablebase
+import game_log
+import model_registry
+import time
 
 class InputAgent():
     '''
@@ -63,15 +66,17 @@ class ValueIterationAgent():
     '''
     ValueIterationで得られた価値を用いて行動するエージェント
     '''
-    def __init__(self, player_mark):
+    def __init__(self, player_mark, gamma=model_registry.DEFAULT_GAMMA,
+                 variant=model_registry.DEFAULT_VARIANT, registry=None):
         self.player_mark = player_mark
+        self.gamma = gamma
+        self.variant = variant
+        # 価値は初めて使うときにレジストリから読み込む（同じ価値は他のエージェントと共有）
+        self.registry = registry or model_registry.default_registry
 
-        if self.player_mark == 1:
-            with open('V_for_CIRCLE.pkl', 'rb') as f:
-                self.V = pickle.load(f)
-        elif self.player_mark == -1:
-            with open('V_for_CROSS.pkl', 'rb') as f:
-                self.V = pickle.load(f)
+    @property
+    def V(self):
+        return self.registry.get('value', self.player_mark, self.gamma, self.variant)
 
     def observe(self, env):
         action_candidates = env.actions_available_at(env.state)
@@ -89,19 +94,20 @@ class ValueIterationAgent():
 
     def policy(self, observation):
         # 価値最大となる行動を1つ見つける
+        V = self.V
         max_V = -np.inf
         policy_action_candidate = None
         for action in observation['action_candidates']:
             expected_next_state = observation['expected_next_states'][action]
-            if self.V[expected_next_state] > max_V:
-                max_V = self.V[expected_next_state]
+            if V[expected_next_state] > max_V:
+                max_V = V[expected_next_state]
                 policy_action_candidate = action
         
         # 価値最大となる行動が複数ある場合は全列挙してからランダムサンプリング
         policy_action_candidates = [policy_action_candidate]
         for action in observation['action_candidates']:
             expected_next_state = observation['expected_next_states'][action]
-            if self.V[expected_next_state] == max_V:
+            if V[expected_next_state] == max_V:
                 policy_action_candidates.append(action)        
         policy_action = random.choice(policy_action_candidates)
 
@@ -112,15 +118,17 @@ class PolicyIterationAgent():
     '''
     PolicyIterationで得られた戦略を用いて行動するエージェント
     '''
-    def __init__(self, player_mark):
+    def __init__(self, player_mark, gamma=model_registry.DEFAULT_GAMMA,
+                 variant=model_registry.DEFAULT_VARIANT, registry=None):
         self.player_mark = player_mark
+        self.gamma = gamma
+        self.variant = variant
+        # 戦略は初めて使うときにレジストリから読み込む（同じ戦略は他のエージェントと共有）
+        self.registry = registry or model_registry.default_registry
 
-        if self.player_mark == 1:
-            with open('policy_for_CIRCLE.pkl', 'rb') as f:
-                self.trained_policy = pickle.load(f)
-        elif self.player_mark == -1:
-            with open('policy_for_CROSS.pkl', 'rb') as f:
-                self.trained_policy = pickle.load(f)
+    @property
+    def trained_policy(self):
+        return self.registry.get('policy', self.player_mark, self.gamma, self.variant)
 
     def observe(self, env):
         action_candidates = env.actions_available_at(env.state)
@@ -141,16 +149,45 @@ class PolicyIterationAgent():
 
     def policy(self, observation):
         s = observation['state']
+        trained_policy = self.trained_policy
         actions = []
         probs = []
-        for a in self.trained_policy[s]:
+        for a in trained_policy[s]:
             actions.append(a)
-            probs.append(self.trained_policy[s][a])
+            probs.append(trained_policy[s][a])
         policy_action = np.random.choice(actions, p=probs)
 
         return policy_action
 
-def main(agent1_str, agent2_str):
+class TablebaseAgent():
+    '''
+    完全読みの結果表（tablebase）から最善手を選択するエージェント
+    '''
+    def __init__(self, player_mark, registry=None):
+        self.player_mark = player_mark
+        self.registry = registry or model_registry.default_registry
+
+    @property
+    def tablebase(self):
+        return self.registry.get('tablebase', None)
+
+    def observe(self, env):
+        action_candidates = env.actions_available_at(env.state)
+
+        observation = {
+            'state': env.state,
+            'action_candidates': action_candidates,
+            'code': tablebase.board_to_code(env.state.board)
+        }
+
+        return observation
+
+    def policy(self, observation):
+        # 最善手が複数ある場合はランダムサンプリング
+        policy_action = random.choice(self.tablebase.best_moves(observation['code']))
+        return policy_action
+
+def main(agent1_str, agent2_str, log_path=None):
     def agent_selctor(agent_str, mark):
         if agent_str == 'input':
             return InputAgent(mark)
@@ -160,6 +197,8 @@ def main(agent1_str, agent2_str):
             return ValueIterationAgent(mark)
         elif agent_str == 'policy':
             return PolicyIterationAgent(mark)
+        elif agent_str == 'tablebase':
+            return TablebaseAgent(mark)
         else:
             raise 'エージェントの指定が間違っています'
 
@@ -181,6 +220,8 @@ def main(agent1_str, agent2_str):
     for _ in range(1):
         # 環境を初期化
         state = env.reset()
+        moves = []
+        started_at = time.monotonic()
         total_reward = 0
         is_done = False
         print('------ 0手目 -----')
@@ -196,6 +237,7 @@ def main(agent1_str, agent2_str):
             observation = agent1.observe(env)
             action = agent1.policy(observation)
             next_state, reward, is_done = env.step(action, 1)
+            moves.append(game_log.ACTIONS.index(action))
             total_reward += reward
             state = copy.deepcopy(next_state)
             print(f'------ {state.step}手目 -----')
@@ -208,6 +250,7 @@ def main(agent1_str, agent2_str):
             observation = agent2.observe(env)
             action = agent2.policy(observation)
             next_state, reward, is_done = env.step(action, -1)
+            moves.append(game_log.ACTIONS.index(action))
             total_reward += reward
             state = copy.deepcopy(next_state)
             print(f'------ {state.step}手目 -----')
@@ -223,5 +266,12 @@ def main(agent1_str, agent2_str):
         elif state.status == tic_tac_toe_environment.Status.DRAW:  
             print('引き分け')
 
+        # 対局記録を追記
+        if log_path is not None:
+            with game_log.GameRecorder(log_path) as recorder:
+                duration_ms = (time.monotonic() - started_at) * 1000
+                recorder.record(agent1_str, agent2_str, moves, state.status, duration_ms)
+
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2])
+    # 3つ目の引数に対局記録のファイルを指定できる
+    main(sys.argv[1], sys.argv[2], *sys.argv[3:4])
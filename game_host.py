@@ -0,0 +1,284 @@
+import tic_tac_toe_environment
+import environment_demo
+import game_log
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import collections
+import argparse
+import asyncio
+import time
+
+# executor上で動かせるエージェント
+AGENT_CHOICES = ['random', 'value', 'policy', 'tablebase']
+
+class ExecutorAgent():
+    '''
+    既存の（同期的な）エージェントをexecutor上で動かす非同期エージェント
+    1手に時間がかかっても他の対局が止まらない
+    '''
+    def __init__(self, agent, executor, name):
+        self.agent = agent
+        self.player_mark = agent.player_mark
+        self.executor = executor
+        self.name = name
+
+    def select_action(self, env, submitted_at):
+        '''
+        worker上で手を選び，(行動, executorの待ち時間, 計算時間)を返す
+        '''
+        started_at = time.monotonic()
+        observation = self.agent.observe(env)
+        action = self.agent.policy(observation)
+        return action, started_at - submitted_at, time.monotonic() - started_at
+
+    async def act(self, env, stats):
+        loop = asyncio.get_running_loop()
+        action, queue_wait, compute = await loop.run_in_executor(
+            self.executor, self.select_action, env, time.monotonic())
+        stats.record_move(self.name, compute, queue_wait)
+        return action
+
+    async def notify_end(self, env):
+        pass
+
+
+class SocketAgent():
+    '''
+    ソケットで接続した人間のプレイヤーから手を受け取る非同期エージェント
+    入力待ちの間も他の対局は進む
+    '''
+    def __init__(self, player_mark, reader, writer):
+        self.player_mark = player_mark
+        self.reader = reader
+        self.writer = writer
+        self.name = 'input'
+
+    async def send(self, text):
+        self.writer.write(text.encode('utf-8'))
+        await self.writer.drain()
+
+    async def send_board(self, state):
+        await self.send(f'------ {state.step}手目 -----\n')
+        for row in state.gboard:
+            await self.send(' '.join(row) + '\n')
+
+    async def act(self, env, stats):
+        action_candidates = env.actions_available_at(env.state)
+        await self.send_board(env.state)
+        started_at = time.monotonic()
+        while True:
+            await self.send('打ちたい場所を入力してください：')
+            line = await self.reader.readline()
+            if not line:
+                raise ConnectionError('プレイヤーの接続が切れました')
+            # 不正なバイト列は入力の誤りとして扱う
+            action_str = line.decode('utf-8', errors='replace').strip()
+            for action in action_candidates:
+                if action.name == action_str:
+                    stats.record_move(self.name, time.monotonic() - started_at)
+                    return action
+            await self.send('入力に誤りがあります\n')
+
+    async def notify_end(self, env):
+        await self.send_board(env.state)
+        await self.send(result_message(env.state) + '\n')
+
+
+def result_message(state):
+    if state.status == tic_tac_toe_environment.Status.CIRCLE_WIN:
+        return '〇（先手）の勝ち'
+    elif state.status == tic_tac_toe_environment.Status.CROSS_WIN:
+        return '×（後手）の勝ち'
+    elif state.status == tic_tac_toe_environment.Status.DRAW:
+        return '引き分け'
+    return '未決着'
+
+
+class HostStats():
+    '''
+    対局中の数，終局数，1手あたりのレイテンシの集計
+    executor上のエージェントは，executorの待ち時間と手の計算時間を分けて集計する
+    '''
+    def __init__(self, window=10000):
+        self.in_flight = 0
+        self.finished = 0
+        self.aborted = 0
+        self.outcomes = collections.Counter()
+        self.move_latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.queue_waits = collections.defaultdict(lambda: collections.deque(maxlen=window))
+
+    def record_move(self, agent_name, latency, queue_wait=None):
+        self.move_latencies[agent_name].append(latency)
+        if queue_wait is not None:
+            self.queue_waits[agent_name].append(queue_wait)
+
+    def summary(self):
+        lines = [f'in flight {self.in_flight}, finished {self.finished}, aborted {self.aborted}, '
+                 f'outcomes {dict(self.outcomes)}']
+        for agent_name, latencies in self.move_latencies.items():
+            if not latencies:
+                continue
+            p50 = np.percentile(latencies, 50) * 1000
+            p99 = np.percentile(latencies, 99) * 1000
+            line = f'    {agent_name}: move latency p50 {p50:.2f}ms, p99 {p99:.2f}ms'
+            queue_waits = self.queue_waits[agent_name]
+            if queue_waits:
+                wait_p50 = np.percentile(queue_waits, 50) * 1000
+                wait_p99 = np.percentile(queue_waits, 99) * 1000
+                line += f' (queue wait p50 {wait_p50:.2f}ms, p99 {wait_p99:.2f}ms)'
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+class GameHost():
+    '''
+    対局ごとにEnvironmentを生成し，多数の対局を並行して進める
+    '''
+    def __init__(self, max_workers=4, recorder=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.stats = HostStats()
+        # 対局記録（game_log.GameRecorder）。Noneなら記録しない
+        self.recorder = recorder
+        # 同じ種類・手番のエージェントは対局間で共有する（テーブルの読み込みは1度だけ）
+        self.agents = {}
+
+    def executor_agent(self, agent_str, mark):
+        key = (agent_str, mark)
+        if key not in self.agents:
+            if agent_str == 'random':
+                agent = environment_demo.RandomAgent(mark)
+            elif agent_str == 'value':
+                agent = environment_demo.ValueIterationAgent(mark)
+            elif agent_str == 'policy':
+                agent = environment_demo.PolicyIterationAgent(mark)
+            elif agent_str == 'tablebase':
+                agent = environment_demo.TablebaseAgent(mark)
+            else:
+                raise ValueError(f'エージェントの指定が間違っています：{agent_str}')
+            self.agents[key] = ExecutorAgent(agent, self.executor, agent_str)
+        return self.agents[key]
+
+    async def play_match(self, agent1, agent2):
+        '''
+        1局を最後まで進め，最終盤面の状態を返す
+        '''
+        env = tic_tac_toe_environment.Environment(1)
+        env.reset()
+        moves = []
+        game_started_at = time.monotonic()
+        self.stats.in_flight += 1
+        try:
+            while True:
+                for agent in (agent1, agent2):
+                    action = await agent.act(env, self.stats)
+                    next_state, _, is_done = env.step(action, agent.player_mark)
+                    moves.append(game_log.ACTIONS.index(action))
+                    if is_done:
+                        break
+                if is_done:
+                    break
+        except Exception:
+            # 接続切れ，テーブルの読み込みの失敗，長すぎる入力などで中断された対局
+            self.stats.aborted += 1
+            raise
+        finally:
+            self.stats.in_flight -= 1
+            # 中断された対局もUNDECIDEDとして記録する
+            if self.recorder is not None:
+                duration_ms = (time.monotonic() - game_started_at) * 1000
+                self.recorder.record(agent1.name, agent2.name, moves,
+                                     env.state.status, duration_ms)
+                self.recorder.flush()
+
+        self.stats.finished += 1
+        self.stats.outcomes[next_state.status.name] += 1
+        for agent in (agent1, agent2):
+            await agent.notify_end(env)
+        return next_state
+
+    async def handle_player(self, reader, writer, opponent_str, human_mark):
+        '''
+        接続してきた人間のプレイヤーとopponent_strのエージェントを対局させる
+        '''
+        human = SocketAgent(human_mark, reader, writer)
+        try:
+            opponent = self.executor_agent(opponent_str, human_mark * -1)
+            if human_mark == 1:
+                await self.play_match(human, opponent)
+            else:
+                await self.play_match(opponent, human)
+        except ConnectionError:
+            pass
+        except Exception as e:
+            # 1つの接続の失敗でサーバ全体を止めない（中断数はplay_matchで数える）
+            try:
+                await human.send(f'対局を中断しました：{e}\n')
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            print(self.stats.summary())
+
+    async def run_bots(self, agent1_str, agent2_str, games, concurrency):
+        '''
+        エージェント同士の対局をgames局，最大concurrency局並行して行う
+        '''
+        agent1 = self.executor_agent(agent1_str, 1)
+        agent2 = self.executor_agent(agent2_str, -1)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one_match():
+            async with semaphore:
+                await self.play_match(agent1, agent2)
+
+        await asyncio.gather(*[one_match() for _ in range(games)])
+
+    async def serve(self, host, port, opponent_str, human_mark):
+        server = await asyncio.start_server(
+            lambda r, w: self.handle_player(r, w, opponent_str, human_mark), host, port)
+        print(f'waiting for players on {host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+
+async def main(args):
+    recorder = game_log.GameRecorder(args.log) if args.log is not None else None
+    host = GameHost(args.workers, recorder)
+    reporter = asyncio.create_task(host.report(args.report_interval))
+    try:
+        if args.port is not None:
+            await host.serve(args.host, args.port, args.opponent, args.human_mark)
+        else:
+            await host.run_bots(args.agent1, args.agent2, args.games, args.concurrency)
+    finally:
+        reporter.cancel()
+        host.executor.shutdown()
+        if recorder is not None:
+            recorder.close()
+        print(host.stats.summary())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    # エージェント同士の対局
+    parser.add_argument('--agent1', choices=AGENT_CHOICES, default='random')
+    parser.add_argument('--agent2', choices=AGENT_CHOICES, default='random')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=1000)
+    # 人間のプレイヤーの受付（--portを指定した場合）
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--opponent', choices=AGENT_CHOICES, default='tablebase')
+    parser.add_argument('--human-mark', type=int, choices=[1, -1], default=1)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--report-interval', type=float, default=5.0)
+    parser.add_argument('--log', default=None)
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,326 @@
+import tic_tac_toe_environment
+import tablebase
+import collections
+import argparse
+import struct
+import zlib
+import os
+
+# 対局記録のバイナリ形式（追記のみ）
+#     ファイル先頭：MAGIC
+#     エージェント名の定義：TAG_AGENT, id（1byte）, 名前の長さ（1byte）, 名前（utf-8）
+#     対局：TAG_GAME, 先手のid（1byte）, 後手のid（1byte）,
+#           手数（bit2〜5）と結果（下位2bit）（1byte）, 対局時間[ms]（可変長整数）,
+#           打ったマス（1手4bit，2手で1byte）
+#     ブロックの終わり：TAG_BLOCK_END, ブロックの長さ（2byte）, ブロックのCRC32（4byte）
+# 1局あたり高々11byte（対局時間が16秒未満なら）
+# 記録はflushごとにブロックとして書き，末尾にTAG_BLOCK_ENDを付ける。
+# 追記時はファイルの末尾から最後の完全なブロックを探すので，ファイル全体を読む必要はない
+# エージェントのidは追記のたびに定義し直す（後の定義が前の定義を上書きする）
+MAGIC = b'TTTLOG2\n'
+TAG_AGENT = 0
+TAG_GAME = 1
+TAG_BLOCK_END = 2
+
+BLOCK_END = struct.Struct('<BHI')
+# ブロックの大きさの目安（これを超えたらブロックを書き出す）
+BLOCK_SIZE = 1 << 15
+# エージェント名の最大長（byte）
+MAX_NAME_BYTES = 255
+# 1件の最大長（新しいエージェント2つの定義と対局）
+MAX_RECORD_BYTES = 2 * (3 + MAX_NAME_BYTES) + 4 + 10 + 5
+
+# 結果の定義（2bit）
+OUTCOMES = [
+    tic_tac_toe_environment.Status.DRAW,
+    tic_tac_toe_environment.Status.CIRCLE_WIN,
+    tic_tac_toe_environment.Status.CROSS_WIN,
+    tic_tac_toe_environment.Status.UNDECIDED # 中断された対局
+]
+
+ACTIONS = list(tic_tac_toe_environment.Actions)
+
+# 読み込み時のバッファサイズ
+CHUNK_SIZE = 1 << 20
+
+GameRecord = collections.namedtuple(
+    'GameRecord', ['agent1', 'agent2', 'moves', 'status', 'duration_ms'])
+
+
+class GameRecorder():
+    '''
+    対局記録をファイルに追記する
+    movesは打ったマスのインデックス（list(Actions)のインデックス）の列
+    '''
+    def __init__(self, path='games.log'):
+        self.path = path
+        is_new = not os.path.exists(path) or os.path.getsize(path) < len(MAGIC)
+        if not is_new:
+            # 書き込み途中で止まった末尾を切り捨ててから追記する
+            end = last_complete_end(path)
+            if end < os.path.getsize(path):
+                os.truncate(path, end)
+        self.file = open(path, 'ab')
+        if is_new:
+            # MAGICの途中で止まったファイルは書き直す
+            self.file.truncate(0)
+            self.file.write(MAGIC)
+        self.block = bytearray()
+        self.agent_ids = {}
+
+    def agent_id(self, name):
+        if name not in self.agent_ids:
+            agent_id = len(self.agent_ids)
+            if agent_id > 255:
+                raise ValueError('エージェントの種類が多すぎます')
+            # 長すぎる名前は文字の境界で切る
+            data = name.encode('utf-8')
+            if len(data) > MAX_NAME_BYTES:
+                data = data[:MAX_NAME_BYTES].decode('utf-8', errors='ignore').encode('utf-8')
+            self.block += bytes([TAG_AGENT, agent_id, len(data)]) + data
+            self.agent_ids[name] = agent_id
+        return self.agent_ids[name]
+
+    def record(self, agent1, agent2, moves, status, duration_ms=0):
+        if len(moves) > 9:
+            raise ValueError('手数が多すぎます')
+        agent1_id = self.agent_id(agent1)
+        agent2_id = self.agent_id(agent2)
+        data = bytearray([TAG_GAME, agent1_id, agent2_id,
+                          len(moves) << 2 | OUTCOMES.index(status)])
+        data += encode_varint(max(int(duration_ms), 0))
+        data += pack_moves(moves)
+        self.block += data
+        if len(self.block) >= BLOCK_SIZE:
+            self.write_block()
+
+    def write_block(self):
+        '''
+        たまった記録をブロックとして書き出す
+        '''
+        if not self.block:
+            return
+        self.file.write(bytes(self.block) +
+                        BLOCK_END.pack(TAG_BLOCK_END, len(self.block), zlib.crc32(self.block)))
+        self.block = bytearray()
+
+    def flush(self):
+        self.write_block()
+        self.file.flush()
+
+    def close(self):
+        self.write_block()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def last_complete_end(path):
+    '''
+    最後の完全なブロックの終わりの位置を返す
+    ファイルの末尾からブロックの終わり（TAG_BLOCK_END）を探し，CRCが合うものを採用する
+    書き込み途中で止まるのは最後のブロックだけなので，末尾の一定範囲だけを見ればよい
+    '''
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'対局記録のファイルではありません：{path}')
+        # 1ブロックは高々BLOCK_SIZE + 1件分なので，書きかけのブロックと
+        # その前の完全なブロックが収まる範囲だけを読む
+        window_start = max(len(MAGIC), size - 2 * (BLOCK_SIZE + MAX_RECORD_BYTES + BLOCK_END.size))
+        f.seek(window_start)
+        window = f.read()
+
+    for end in range(len(window), BLOCK_END.size - 1, -1):
+        tag, length, crc = BLOCK_END.unpack_from(window, end - BLOCK_END.size)
+        start = end - BLOCK_END.size - length
+        if tag != TAG_BLOCK_END or start < 0:
+            continue
+        if zlib.crc32(window[start:end - BLOCK_END.size]) == crc:
+            return window_start + end
+
+    # ブロックが1つもなければMAGICの直後まで戻す
+    if window_start == len(MAGIC):
+        return len(MAGIC)
+    raise ValueError(f'対局記録が壊れています：{path}')
+
+
+def encode_varint(value):
+    '''
+    7bitずつ下位から書き，続きがある場合は最上位bitを立てる
+    '''
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+def pack_moves(moves):
+    '''
+    打ったマス（0〜8）を1手4bitで詰める
+    '''
+    data = bytearray((len(moves) + 1) // 2)
+    for i, cell in enumerate(moves):
+        data[i // 2] |= cell << (4 * (i % 2))
+    return bytes(data)
+
+def unpack_moves(data, num_moves):
+    return tuple((data[i // 2] >> (4 * (i % 2))) & 0x0F for i in range(num_moves))
+
+
+def read_records(path='games.log'):
+    '''
+    対局記録を1件ずつ返すジェネレータ
+    エージェント名の定義は('agent', id, 名前)，対局は('game', GameRecord)として返す
+    ファイルはCHUNK_SIZEずつ読むので，全体をメモリに載せることはない
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'対局記録のファイルではありません：{path}')
+
+        agent_names = {}
+        buf = b''
+        pos = 0
+        eof = False
+        while True:
+            # 残りが少なくなったら読み足す
+            if not eof and len(buf) - pos < 512:
+                chunk = f.read(CHUNK_SIZE)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+            if pos >= len(buf):
+                return
+
+            try:
+                record, pos = parse_record(buf, pos, agent_names)
+            except IndexError:
+                # 書き込み途中で止まった末尾の1件は読み飛ばす
+                if eof:
+                    return
+                # 1件がバッファの末尾をまたいでいる場合は読み足して読み直す
+                chunk = f.read(CHUNK_SIZE)
+                eof = not chunk
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            # ブロックの終わりは記録としては返さない
+            if record is not None:
+                yield record
+
+def parse_record(buf, pos, agent_names):
+    '''
+    buf[pos:]から1件読み，(記録, 次の位置)を返す。ブロックの終わりの記録はNone
+    '''
+    tag = buf[pos]
+    if tag == TAG_BLOCK_END:
+        if len(buf) < pos + BLOCK_END.size:
+            raise IndexError('対局記録が途中で切れています')
+        return None, pos + BLOCK_END.size
+    elif tag == TAG_AGENT:
+        agent_id, length = buf[pos + 1], buf[pos + 2]
+        data = buf[pos + 3:pos + 3 + length]
+        if len(data) < length:
+            raise IndexError('対局記録が途中で切れています')
+        name = data.decode('utf-8', errors='replace')
+        agent_names[agent_id] = name
+        return ('agent', agent_id, name), pos + 3 + length
+    elif tag == TAG_GAME:
+        agent1, agent2, header = buf[pos + 1], buf[pos + 2], buf[pos + 3]
+        pos += 4
+        duration_ms = 0
+        shift = 0
+        while True:
+            byte = buf[pos]
+            pos += 1
+            duration_ms |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        num_moves = header >> 2
+        moves = unpack_moves(buf[pos:pos + (num_moves + 1) // 2], num_moves)
+        pos += (num_moves + 1) // 2
+        if agent1 not in agent_names or agent2 not in agent_names:
+            raise ValueError(f'対局記録が壊れています（未定義のエージェント{agent1}, {agent2}）')
+        record = GameRecord(agent_names[agent1], agent_names[agent2],
+                            moves, OUTCOMES[header & 0x03], duration_ms)
+        return ('game', record), pos
+    else:
+        raise ValueError(f'対局記録が壊れています（tag {tag}）')
+
+def read_games(path='games.log'):
+    '''
+    対局（GameRecord）だけを1件ずつ返すジェネレータ
+    '''
+    for record in read_records(path):
+        if record[0] == 'game':
+            yield record[1]
+
+
+def replay(game):
+    '''
+    対局記録をEnvironment.stepで再生し，1手ごとに(行動, 次の状態, 報酬, 終了判定)を返す
+    '''
+    env = tic_tac_toe_environment.Environment(1)
+    env.reset()
+    for i, cell in enumerate(game.moves):
+        mark = 1 if i % 2 == 0 else -1
+        next_state, reward, is_done = env.step(ACTIONS[cell], mark)
+        yield ACTIONS[cell], next_state, reward, is_done
+
+
+def aggregate(games):
+    '''
+    対局記録を1件ずつ読みながら集計する
+    outcomes：結果ごとの対局数
+    openings：初手のマスごとの対局数
+    position_moves：盤面コードごとの，打たれたマスの分布
+    '''
+    outcomes = collections.Counter()
+    openings = collections.Counter()
+    position_moves = collections.defaultdict(collections.Counter)
+    num_games = 0
+    empty_code = sum(tablebase.POWERS)
+    for game in games:
+        num_games += 1
+        outcomes[game.status.name] += 1
+        if game.moves:
+            openings[ACTIONS[game.moves[0]].name] += 1
+        # 盤面コードを差分で更新しながら辿る
+        code = empty_code
+        mark = 1
+        for cell in game.moves:
+            position_moves[code][cell] += 1
+            code += mark * tablebase.POWERS[cell]
+            mark *= -1
+
+    return {
+        'games': num_games,
+        'outcomes': outcomes,
+        'openings': openings,
+        'position_moves': position_moves
+    }
+
+
+def main(path='games.log'):
+    stats = aggregate(read_games(path))
+    games = stats['games']
+    print(f'games: {games}')
+    for name, count in stats['outcomes'].most_common():
+        print(f'    {name}: {count} ({count / games:.1%})')
+    print('openings:')
+    for name, count in stats['openings'].most_common():
+        print(f'    {name}: {count} ({count / games:.1%})')
+    print(f'positions seen: {len(stats["position_moves"])}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', nargs='?', default='games.log')
+    args = parser.parse_args()
+    main(args.path)
@@ -0,0 +1,163 @@
+import tablebase
+import numpy as np
+import collections
+import threading
+import pickle
+import enum
+import time
+import sys
+import os
+
+# planner.pyのデフォルトの割引率（このときはファイル名にgammaを付けない）
+DEFAULT_GAMMA = 0.9
+DEFAULT_VARIANT = 'standard'
+
+MARK_NAMES = {1: 'CIRCLE', -1: 'CROSS'}
+
+def table_path(algorithm, player_mark, gamma=DEFAULT_GAMMA, variant=DEFAULT_VARIANT, directory='.'):
+    '''
+    学習済みテーブルのファイル名を返す
+    デフォルトの設定ではV_for_CIRCLE.pklなど従来のファイル名になる
+    '''
+    if algorithm == 'tablebase':
+        name = 'tablebase'
+    elif algorithm == 'value':
+        name = f'V_for_{MARK_NAMES[player_mark]}'
+    elif algorithm == 'policy':
+        name = f'policy_for_{MARK_NAMES[player_mark]}'
+    else:
+        raise ValueError(f'アルゴリズムの指定が間違っています：{algorithm}')
+
+    if algorithm != 'tablebase' and gamma != DEFAULT_GAMMA:
+        name += f'_gamma{gamma}'
+    if variant != DEFAULT_VARIANT:
+        name += f'_{variant}'
+    extension = '.bin' if algorithm == 'tablebase' else '.pkl'
+    return os.path.join(directory, name + extension)
+
+
+def estimate_bytes(obj):
+    '''
+    オブジェクトが参照しているもの全体のメモリ上のサイズを見積もる
+    Enumのメンバやクラスなど，他と共有されるものは数えない
+    '''
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, (enum.Enum, type)):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif isinstance(o, np.ndarray):
+            # 他の配列のviewであれば元の配列のデータを数える
+            if o.base is not None:
+                stack.append(o.base)
+        elif hasattr(o, '__dict__'):
+            stack.append(o.__dict__)
+    return total
+
+
+class ModelRegistry():
+    '''
+    学習済みテーブルをプロセス全体で共有するレジストリ
+    (algorithm, player_mark, gamma, variant)をキーとして，初めて使われたときに読み込み，
+    同じキーのエージェントは1つのテーブルを共有する
+    メモリ上の合計サイズがmax_bytesを超えたら最も長く使われていないテーブルから捨てる
+    （サイズは読み込み時にestimate_bytesで見積もる。max_bytes=Noneなら捨てない）
+    読み込みはロックの外で行うので，読み込み中も読み込み済みのテーブルはすぐに返せる
+    '''
+    def __init__(self, max_bytes=None, directory='.'):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.lock = threading.Lock()
+        # キー -> (テーブル, サイズ)。末尾ほど最近使われたもの
+        self.tables = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_seconds = collections.defaultdict(float)
+        # 読み込み中のキー -> 読み込み完了を知らせるEvent
+        self.loading = {}
+
+    def get(self, algorithm, player_mark, gamma=DEFAULT_GAMMA, variant=DEFAULT_VARIANT):
+        key = (algorithm, player_mark, gamma, variant)
+        while True:
+            with self.lock:
+                if key in self.tables:
+                    self.hits += 1
+                    self.tables.move_to_end(key)
+                    return self.tables[key][0]
+                # 他のスレッドが読み込み中なら，終わるのを待ってから見直す
+                loaded = self.loading.get(key)
+                if loaded is None:
+                    self.misses += 1
+                    loaded = self.loading[key] = threading.Event()
+                    break
+            loaded.wait()
+
+        try:
+            started_at = time.monotonic()
+            path = table_path(algorithm, player_mark, gamma, variant, self.directory)
+            table = self.__load(algorithm, path)
+            size = estimate_bytes(table)
+            load_seconds = time.monotonic() - started_at
+
+            with self.lock:
+                self.load_seconds[key] += load_seconds
+                self.tables[key] = (table, size)
+                self.total_bytes += size
+                self.__evict()
+            return table
+        finally:
+            with self.lock:
+                del self.loading[key]
+            loaded.set()
+
+    def __load(self, algorithm, path):
+        if algorithm == 'tablebase':
+            return tablebase.Tablebase.load(path)
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def __evict(self):
+        # 今読み込んだテーブル（末尾）は残す
+        while self.max_bytes is not None and \
+            self.total_bytes > self.max_bytes and len(self.tables) > 1:
+            _, (_, size) = self.tables.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.__evict()
+
+    def clear(self):
+        with self.lock:
+            self.tables.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'tables': list(self.tables),
+                'total_bytes': self.total_bytes,
+                'sizes': {key: size for key, (_, size) in self.tables.items()},
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'load_seconds': dict(self.load_seconds)
+            }
+
+
+# プロセス全体で共有するレジストリ
+default_registry = ModelRegistry()
@@ -0,0 +1,372 @@
+import tic_tac_toe_environment
+import tablebase
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import collections
+import threading
+import argparse
+import pickle
+import queue
+import json
+import time
+import os
+
+# 盤面コードの桁の重み（numpy配列版）
+POWERS = np.array(tablebase.POWERS)
+# 行動一覧（インデックスi がマス3r+cに対応）
+ACTIONS = list(tic_tac_toe_environment.Actions)
+
+# best_actionsの戻り値で，打てない盤面と手番のテーブルがない盤面を表す
+NOT_PLAYABLE = -1
+MISSING_TABLE = -2
+
+# リクエストの本文の最大長（byte）
+MAX_BODY = 4096
+
+
+class MoveTables():
+    '''
+    学習済みの価値，戦略，結果表を盤面コードで引ける配列にまとめたもの
+    self.playable（盤面コードごとに，未決着で手が打てる盤面ならTrue）
+    self.V（self.V[mark]：手番markの価値。盤面コードで引く）
+    self.policy_action（self.policy_action[mark]：手番markの戦略が選ぶ行動の
+                       インデックス。戦略がない盤面は-1）
+    self.best_move_masks（結果表の最善手のビットマスク）
+    '''
+    def __init__(self, directory='.'):
+        self.playable = np.zeros(tablebase.NUM_CODES, dtype=bool)
+        env = tic_tac_toe_environment.Environment(1)
+        for s in env.states:
+            if s.status == tic_tac_toe_environment.Status.UNDECIDED:
+                self.playable[tablebase.board_to_code(s.board)] = True
+
+        self.V = {}
+        self.policy_action = {}
+        for mark, name in [(1, 'CIRCLE'), (-1, 'CROSS')]:
+            V = self.__load_pickle(os.path.join(directory, f'V_for_{name}.pkl'))
+            if V is not None:
+                self.V[mark] = self.__V_to_array(V)
+            policy = self.__load_pickle(os.path.join(directory, f'policy_for_{name}.pkl'))
+            if policy is not None:
+                self.policy_action[mark] = self.__policy_to_array(policy)
+
+        self.best_move_masks = None
+        tablebase_path = os.path.join(directory, 'tablebase.bin')
+        if os.path.exists(tablebase_path):
+            masks = tablebase.Tablebase.load(tablebase_path).best_move_masks
+            self.best_move_masks = np.array(masks, dtype=np.int64)
+
+    def __load_pickle(self, path):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def __V_to_array(self, V):
+        array = np.full(tablebase.NUM_CODES, -np.inf)
+        for s in V:
+            array[tablebase.board_to_code(s.board)] = V[s]
+        return array
+
+    def __policy_to_array(self, policy):
+        array = np.full(tablebase.NUM_CODES, -1, dtype=np.int64)
+        for s in policy:
+            action = max(policy[s], key=policy[s].get)
+            array[tablebase.board_to_code(s.board)] = ACTIONS.index(action)
+        return array
+
+    @property
+    def agents(self):
+        '''
+        読み込めたテーブルから使えるエージェント一覧
+        '''
+        agents = []
+        if self.V:
+            agents.append('value')
+        if self.policy_action:
+            agents.append('policy')
+        if self.best_move_masks is not None:
+            agents.append('tablebase')
+        return agents
+
+    def best_actions(self, agent, codes):
+        '''
+        盤面コードの配列codesに対して，エージェントagentが選ぶ行動の
+        インデックスの配列を返す（まとめて引く）
+        打てない盤面はNOT_PLAYABLE，手番のテーブルがない盤面はMISSING_TABLE
+        '''
+        digits = (codes[:, None] // POWERS[None, :]) % 3
+        empty = digits == 1
+        # 盤面の総和（〇の数-×の数）が0なら先手番
+        marks = np.where((digits - 1).sum(axis=1) == 0, 1, -1)
+
+        if agent == 'value':
+            # 次の盤面の価値が最大となる行動
+            next_codes = codes[:, None] + marks[:, None] * POWERS[None, :]
+            next_codes = np.where(empty, next_codes, 0)
+            values = np.full(empty.shape, -np.inf)
+            for mark in self.V:
+                rows = marks == mark
+                values[rows] = self.V[mark][next_codes[rows]]
+            values[~empty] = -np.inf
+            actions = np.argmax(values, axis=1)
+            actions[~np.isfinite(values.max(axis=1))] = NOT_PLAYABLE
+            actions[~np.isin(marks, list(self.V))] = MISSING_TABLE
+        elif agent == 'policy':
+            actions = np.full(len(codes), MISSING_TABLE, dtype=np.int64)
+            for mark in self.policy_action:
+                rows = marks == mark
+                actions[rows] = self.policy_action[mark][codes[rows]]
+        elif agent == 'tablebase':
+            # 最善手のうち最も若いマス
+            masks = self.best_move_masks[codes]
+            bits = (masks[:, None] >> np.arange(9)[None, :]) & 1
+            actions = np.where(masks > 0, np.argmax(bits, axis=1), NOT_PLAYABLE)
+        else:
+            raise ValueError(f'エージェントの指定が間違っています：{agent}')
+
+        actions[~self.playable[codes]] = NOT_PLAYABLE
+        return actions
+
+
+class Metrics():
+    '''
+    レイテンシとQPSの計測
+    QPSは直近qps_window秒に終わったリクエスト（エラーを含む）から求める
+    '''
+    def __init__(self, window=10000, qps_window=10.0):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.finished_at = collections.deque()
+        self.qps_window = qps_window
+        self.requests = 0
+        self.errors = 0
+        self.started_at = time.monotonic()
+
+    def __finish(self, now):
+        self.requests += 1
+        self.finished_at.append(now)
+        while self.finished_at[0] < now - self.qps_window:
+            self.finished_at.popleft()
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.__finish(time.monotonic())
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+            self.__finish(time.monotonic())
+
+    def record_batch(self, size):
+        with self.lock:
+            self.batch_sizes.append(size)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            latencies = np.array(self.latencies)
+            batch_sizes = np.array(self.batch_sizes)
+            requests = self.requests
+            errors = self.errors
+            recent = sum(1 for t in self.finished_at if t >= now - self.qps_window)
+        # 起動直後は経過時間で割る
+        window = min(self.qps_window, now - self.started_at)
+        snapshot = {
+            'requests': requests,
+            'errors': errors,
+            'qps': recent / window if window > 0 else 0.0,
+            'p50_ms': None,
+            'p99_ms': None,
+            'mean_batch_size': None
+        }
+        if len(latencies):
+            snapshot['p50_ms'] = float(np.percentile(latencies, 50)) * 1000
+            snapshot['p99_ms'] = float(np.percentile(latencies, 99)) * 1000
+        if len(batch_sizes):
+            snapshot['mean_batch_size'] = float(batch_sizes.mean())
+        return snapshot
+
+
+class MoveBatcher():
+    '''
+    同時に来たリクエストをまとめて1回の配列演算で処理する
+    最初のリクエストからmax_wait秒待つか，max_batch件たまった時点で処理する
+    '''
+    def __init__(self, tables, metrics, max_batch=256, max_wait=0.001):
+        self.tables = tables
+        self.metrics = metrics
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def submit(self, agent, code):
+        '''
+        行動のインデックスを返す（処理されるまでブロックする）
+        '''
+        request = {
+            'agent': agent,
+            'code': code,
+            'done': threading.Event(),
+            'action': -1,
+            'error': None
+        }
+        self.requests.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['action']
+
+    def __collect(self):
+        batch = [self.requests.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def __run(self):
+        while True:
+            batch = self.__collect()
+            self.metrics.record_batch(len(batch))
+
+            # エージェントごとにまとめて引く
+            by_agent = collections.defaultdict(list)
+            for request in batch:
+                by_agent[request['agent']].append(request)
+            for agent, requests in by_agent.items():
+                codes = np.array([r['code'] for r in requests], dtype=np.int64)
+                try:
+                    actions = self.tables.best_actions(agent, codes)
+                    for request, action in zip(requests, actions):
+                        request['action'] = int(action)
+                except Exception as e:
+                    for request in requests:
+                        request['error'] = e
+                for request in requests:
+                    request['done'].set()
+
+
+def board_to_code(board):
+    '''
+    JSONの盤面（長さ9のリスト，または3x3のリスト）を盤面コードに変換する
+    numpyに渡す前に各マスが整数の-1, 0, 1であることを確かめる（小数や巨大な整数を弾く）
+    '''
+    if isinstance(board, list) and len(board) == 3 and \
+        all(isinstance(row, list) and len(row) == 3 for row in board):
+        board = [cell for row in board for cell in row]
+    if not isinstance(board, list) or len(board) != 9 or \
+        not all(type(cell) is int and cell in (-1, 0, 1) for cell in board):
+        raise ValueError('盤面は-1, 0, 1からなる9マスで指定してください')
+    cells = np.array(board, dtype=np.int64)
+    return int(((cells + 1) * POWERS).sum())
+
+
+class MoveRequestHandler(BaseHTTPRequestHandler):
+    '''
+    POST /move：{"board": [...], "agent": "value"} に対して最善手を返す
+    GET /metrics：レイテンシとQPSを返す
+    '''
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = self.server.metrics.snapshot()
+            body['agents'] = self.server.tables.agents
+            self.__send_json(200, body)
+        else:
+            self.__send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/move':
+            self.__send_json(404, {'error': 'not found'})
+            return
+
+        started_at = time.monotonic()
+        try:
+            length = int(self.headers.get('Content-Length', -1))
+            if not 0 <= length <= MAX_BODY:
+                raise ValueError(f'Content-Lengthは0〜{MAX_BODY}で指定してください')
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError('リクエストはJSONのオブジェクトで指定してください')
+            agent = request.get('agent', 'value')
+            if agent not in self.server.tables.agents:
+                raise ValueError(f'エージェントが使えません：{agent}')
+            code = board_to_code(request['board'])
+            action = self.server.batcher.submit(agent, code)
+        except (ValueError, KeyError, TypeError, OverflowError) as e:
+            self.server.metrics.record_error()
+            self.__send_json(400, {'error': str(e)})
+            return
+
+        if action == MISSING_TABLE:
+            self.server.metrics.record_error()
+            self.__send_json(400, {'error': f'この手番の{agent}のテーブルがありません'})
+            return
+        if action == NOT_PLAYABLE:
+            self.server.metrics.record_error()
+            self.__send_json(400, {'error': '手を打てる盤面ではありません'})
+            return
+        self.server.metrics.record(time.monotonic() - started_at)
+        self.__send_json(200, {
+            'action': ACTIONS[action].name,
+            'cell': list(ACTIONS[action].value)
+        })
+
+    def __send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # リクエストごとのログは出さない
+        pass
+
+
+class MoveServer(ThreadingHTTPServer):
+    '''
+    テーブルを1度だけ読み込んで手を返すサーバ
+    '''
+    daemon_threads = True
+    # 同時接続が多くても接続を取りこぼさないようにする
+    request_queue_size = 128
+
+    def __init__(self, address, tables, max_batch=256, max_wait=0.001):
+        super().__init__(address, MoveRequestHandler)
+        self.tables = tables
+        self.metrics = Metrics()
+        self.batcher = MoveBatcher(tables, self.metrics, max_batch, max_wait)
+
+
+def main(host='127.0.0.1', port=8000, directory='.', max_batch=256, max_wait=0.001):
+    tables = MoveTables(directory)
+    server = MoveServer((host, port), tables, max_batch, max_wait)
+    print(f'serving {tables.agents} on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--dir', dest='directory', default='.')
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=1.0)
+    args = parser.parse_args()
+    main(args.host, args.port, args.directory, args.max_batch, args.max_wait_ms / 1000)
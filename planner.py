@@ -1,5 +1,26 @@
 import tic_tac_toe_environment
+import model_registry
 import pickle
+import os
+import argparse
+import sys
+
+def is_checkpoint(obj):
+    '''
+    途中経過（チェックポイント）であればTrueを返す
+    学習済みのV，戦略は盤面（State）がキーなので，キーが文字列かどうかで区別する
+    '''
+    if not isinstance(obj, dict) or not obj:
+        raise ValueError('warm startには途中経過，学習済みのVまたは戦略を指定してください')
+    return isinstance(next(iter(obj)), str)
+
+def is_V_table(obj):
+    '''
+    学習済みのV（盤面 -> 価値）であればTrueを返す
+    学習済みの戦略は盤面 -> {行動: 確率}の辞書
+    '''
+    return not is_checkpoint(obj) and not isinstance(next(iter(obj.values())), dict)
+
 
 class Planner():
     '''
@@ -13,6 +34,51 @@ class Planner():
         self.env.reset()
         self.log = []
 
+    def initial_V(self, warm_V=None):
+        '''
+        価値Vの初期値を返す
+        warm_Vが与えられた場合，未決着の盤面はその値から始める（warm start）
+        '''
+        V = {}
+        for s in self.env.states:
+            # 勝利盤面ではvalue=1，敗北盤面ではvalue=-1，それ以外はvalue=0で初期化
+            if s.status.value == self.env.player_mark:
+                V[s] = 1
+            elif s.status.value == self.env.player_mark * -1:
+                V[s] = -1
+            elif warm_V is not None and s in warm_V:
+                V[s] = warm_V[s]
+            else:
+                V[s] = 0
+        return V
+
+    def resume_count(self, checkpoint, plan_type, gamma):
+        '''
+        途中経過から再開するときの反復回数を返す
+        手番が異なる途中経過はエラーとし，手法やgammaが異なる場合は
+        価値を初期値として使うだけで反復回数は0から数える
+        '''
+        if checkpoint['player_mark'] != self.env.player_mark:
+            raise ValueError(f'手番が異なる途中経過です：'
+                             f'{checkpoint["player_mark"]} != {self.env.player_mark}')
+        if checkpoint['plan_type'] != plan_type:
+            print(f'{checkpoint["plan_type"]}の途中経過の価値を初期値として使います')
+            return 0
+        if checkpoint['gamma'] != gamma:
+            print(f'途中経過のgamma（{checkpoint["gamma"]}）と異なるgamma（{gamma}）で再計算します')
+            return 0
+        return checkpoint['count']
+
+    def save_checkpoint(self, path, checkpoint):
+        '''
+        途中経過を保存する。書き込み途中で中断しても壊れないように
+        一時ファイルに書いてから置き換える
+        '''
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(checkpoint, f)
+        os.replace(tmp_path, path)
+
     def transitions_at(self, state, action, mark):
         transition_probs = self.env.transit_func(state, action, mark)
         for next_state in transition_probs:
@@ -30,23 +96,28 @@ class ValueIterationPlanner(Planner):
     def __init__(self, env):
         super().__init__(env)
 
-    def plan(self, gamma=0.9, threshold=0.0001):
+    def plan(self, gamma=0.9, threshold=0.0001, warm_start=None,
+             checkpoint_path=None, checkpoint_interval=10):
+        '''
+        warm_start：途中経過（チェックポイント）または学習済みのVから再開する
+        checkpoint_path：checkpoint_interval回ごとに途中経過を保存するファイル
+        '''
         self.initialize()
         # 価値と（取れる行動と次の状態）の組を保存する辞書
-        V = {}
-        # 初期化
-        for s in self.env.states:
-            # 勝利盤面ではvalue=1，敗北盤面ではvalue=-1，それ以外はvalue=0で初期化
-            if s.status.value == self.env.player_mark:
-                V[s] = 1
-            elif s.status.value == self.env.player_mark * -1:
-                V[s] = -1
-            else:
-                V[s] = 0
+        # 初期化（warm startの場合は与えられた価値から始める）
+        count = 0
+        if warm_start is None:
+            V = self.initial_V()
+        elif is_checkpoint(warm_start):
+            V = self.initial_V(warm_start['V'])
+            count = self.resume_count(warm_start, 'value', gamma)
+        elif is_V_table(warm_start):
+            V = self.initial_V(warm_start)
+        else:
+            raise ValueError('value iterationのwarm startには途中経過かVを指定してください')
 
         # Bellman方程式を反復解法で解く
         # 価値の更新幅（の最大値）がthreshold未満になれば終了
-        count = 0
         while True:
             delta = 0
             for s in V:
@@ -73,6 +144,16 @@ class ValueIterationPlanner(Planner):
 
             count += 1
             print(f'iteration {count}, delta {delta}')
+            # checkpoint_interval回ごと，および収束時に途中経過を保存
+            if checkpoint_path is not None and \
+                (count % checkpoint_interval == 0 or delta < threshold):
+                self.save_checkpoint(checkpoint_path, {
+                    'plan_type': 'value',
+                    'player_mark': self.env.player_mark,
+                    'gamma': gamma,
+                    'count': count,
+                    'V': V
+                })
             if delta < threshold:
                 break
 
@@ -84,30 +165,57 @@ class PolicyIterationPlanner(Planner):
         super().__init__(env)
         self.policy = {}
 
-    def initialize(self):
+    def initialize(self, warm_policy=None):
         super().initialize()
         self.policy = {}
         states = self.env.states
         # 戦略の初期化。初期の行動確率は平等にする
+        # （warm startの場合は与えられた戦略から始める）
         for s in states:
             # 未決着の盤面のみpolicyを求める
             if s.status != tic_tac_toe_environment.Status.UNDECIDED:
                 continue
+            if warm_policy is not None and s in warm_policy:
+                self.policy[s] = dict(warm_policy[s])
+                continue
             self.policy[s] = {}
             for a in self.env.actions_available_at(s):
                 self.policy[s][a] = 1 / len(self.env.actions_available_at(s))
 
-    def estimate_by_policy(self, gamma, threshold):
-        V = {}
-        # 価値Vを初期化
-        for s in self.env.states:
-            # 勝利盤面ではvalue=1，敗北盤面ではvalue=-1，それ以外はvalue=0で初期化
-            if s.status.value == self.env.player_mark:
-                V[s] = 1
-            elif s.status.value == self.env.player_mark * -1:
-                V[s] = -1
-            else:
-                V[s] = 0
+    def initialize_greedy(self, V, gamma):
+        '''
+        価値Vに対して貪欲な戦略で初期化する（Vからのwarm start用）
+        '''
+        self.initialize()
+        V = self.initial_V(V)
+        for s in self.policy:
+            best_action = self.best_action_at(s, V, gamma)
+            for a in self.policy[s]:
+                self.policy[s][a] = 1 if a == best_action else 0
+
+    def best_action_at(self, s, V, gamma):
+        '''
+        価値Vのもとで状態sにおける最善の行動を返す
+        '''
+        # 各行動を取った場合の報酬を求めて比較する
+        action_rewards = {}
+        for a in self.env.actions_available_at(s):
+            r = 0
+            for prob, next_state, reward in self.transitions_at(s, a, s.turn.value):
+                r += prob * (reward + gamma * V[next_state])
+            action_rewards[a] = r
+
+        # プレイヤーの手番の場合は一番報酬が高い行動がベスト
+        if s.turn.value == self.env.player_mark:
+            return max(action_rewards, key=action_rewards.get)
+        # 相手の手番の場合は一番報酬が低い行動が選ばれるとする
+        # （相手も勝ちに来るため）
+        else:
+            return min(action_rewards, key=action_rewards.get)
+
+    def estimate_by_policy(self, gamma, threshold, warm_V=None):
+        # 価値Vを初期化（warm_Vが与えられた場合はその値から始める）
+        V = self.initial_V(warm_V)
 
         count = 0
         while True:
@@ -136,24 +244,43 @@ class PolicyIterationPlanner(Planner):
 
         return V
 
-    def plan(self, gamma=0.9, threshold=0.0001):
-        self.initialize()
+    def plan(self, gamma=0.9, threshold=0.0001, warm_start=None,
+             checkpoint_path=None, checkpoint_interval=1):
+        '''
+        warm_start：途中経過（チェックポイント），学習済みの戦略またはVから再開する
+        （Vの場合はVに対して貪欲な戦略から始め，Vを最初の戦略評価の初期値として使う）
+        checkpoint_path：checkpoint_interval回ごとに途中経過を保存するファイル
+        '''
+        count = 0
+        V = None
+        if warm_start is None:
+            self.initialize()
+        elif is_checkpoint(warm_start):
+            V = warm_start['V']
+            count = self.resume_count(warm_start, 'policy', gamma)
+            # value iterationの途中経過には戦略がないので，価値から貪欲な戦略を作る
+            if 'policy' in warm_start:
+                self.initialize(warm_start['policy'])
+            else:
+                self.initialize_greedy(V, gamma)
+        elif is_V_table(warm_start):
+            V = warm_start
+            self.initialize_greedy(V, gamma)
+        else:
+            self.initialize(warm_start)
         states = self.env.states
 
         def take_max_action(action_value_dict):
             return max(action_value_dict, key=action_value_dict.get)
 
-        def take_min_action(action_value_dict):
-            return min(action_value_dict, key=action_value_dict.get)
-
-        count = 0
         while True:
             count += 1
             print(f'Policy iteration {count}')
 
             update_stable = True
             # 現在の戦略のもとでVをValueIterationで求める
-            V = self.estimate_by_policy(gamma, threshold)
+            # 2回目以降は直前の戦略での価値から始めると少ない反復で収束する
+            V = self.estimate_by_policy(gamma, threshold, V)
 
             for s in states:
                 # 未決着の盤面のみ考える
@@ -164,20 +291,7 @@ class PolicyIterationPlanner(Planner):
                 policy_action = take_max_action(self.policy[s])
 
                 # 他の行動を取った場合の報酬も求めて比較する
-                action_rewards = {}
-                for a in self.env.actions_available_at(s):
-                    r = 0
-                    for prob, next_state, reward in self.transitions_at(s, a, s.turn.value):
-                        r += prob * (reward + gamma * V[next_state])
-                    action_rewards[a] = r
-                
-                # プレイヤーの手番の場合は一番報酬が高い行動がベスト
-                if s.turn.value == self.env.player_mark:
-                    best_action = take_max_action(action_rewards)
-                # 相手の手番の場合は一番報酬が低い行動が選ばれるとする
-                # （相手も勝ちに来るため）
-                else:
-                    best_action = take_min_action(action_rewards)
+                best_action = self.best_action_at(s, V, gamma)
 
                 # 戦略が導きだす行動が他の行動候補と比較してベストな洗濯であればOK
                 # そうでなければupdate_stable=Falseとしてイタレーション
@@ -190,6 +304,18 @@ class PolicyIterationPlanner(Planner):
                     prob = 1 if a == best_action else 0
                     self.policy[s][a] = prob
 
+            # checkpoint_interval回ごと，および収束時に途中経過を保存
+            if checkpoint_path is not None and \
+                (count % checkpoint_interval == 0 or update_stable):
+                self.save_checkpoint(checkpoint_path, {
+                    'plan_type': 'policy',
+                    'player_mark': self.env.player_mark,
+                    'gamma': gamma,
+                    'count': count,
+                    'V': V,
+                    'policy': self.policy
+                })
+
             # 戦略がとる行動が安定すれば終了
             if update_stable:
                 break
@@ -197,38 +323,61 @@ class PolicyIterationPlanner(Planner):
         return self.policy
 
 
-def main(player_mark, plan_type):
+def main(player_mark, plan_type, gamma=None, warm_start_path=None, checkpoint_path=None):
     env = tic_tac_toe_environment.Environment(player_mark)
+
+    # warm start用の途中経過または学習済みのV，戦略を読み込む
+    warm_start = None
+    if warm_start_path is not None:
+        with open(warm_start_path, 'rb') as f:
+            warm_start = pickle.load(f)
+
+    # gammaの指定がなければ，途中経過から再開する場合はそのgamma，それ以外は0.9
+    if gamma is None:
+        if warm_start is not None and is_checkpoint(warm_start):
+            gamma = warm_start['gamma']
+        else:
+            gamma = 0.9
+
     # value iteration
     if plan_type == 'value':
         # value iterationで価値を求める
         planner = ValueIterationPlanner(env)
-        V = planner.plan()
+        V = planner.plan(gamma, warm_start=warm_start, checkpoint_path=checkpoint_path)
 
-        # 得られた価値関数を保存
-        if player_mark == 1:
-            with open('V_for_CIRCLE.pkl', 'wb') as f:
-                pickle.dump(V, f)
-        elif player_mark == -1:
-            with open('V_for_CROSS.pkl', 'wb') as f:
-                pickle.dump(V, f)
+        # 得られた価値関数を保存（gammaがデフォルト以外ならファイル名にgammaが付く）
+        with open(model_registry.table_path('value', player_mark, gamma), 'wb') as f:
+            pickle.dump(V, f)
 
     # policy iteration
     elif plan_type == 'policy':
         # policy iterationで戦略を求める
         planner = PolicyIterationPlanner(env)
-        policy = planner.plan()
+        policy = planner.plan(gamma, warm_start=warm_start, checkpoint_path=checkpoint_path)
+
+        # 得られた戦略を保存（gammaがデフォルト以外ならファイル名にgammaが付く）
+        with open(model_registry.table_path('policy', player_mark, gamma), 'wb') as f:
+            pickle.dump(policy, f)
 
-        # 得られた戦略を保存
-        if player_mark == 1:
-            with open('policy_for_CIRCLE.pkl', 'wb') as f:
-                pickle.dump(policy, f)
-        elif player_mark == -1:
-            with open('policy_for_CROSS.pkl', 'wb') as f:
-                pickle.dump(policy, f)
 
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('plan_type', choices=['value', 'policy'])
+    parser.add_argument('player_mark', type=int, choices=[1, -1])
+    parser.add_argument('--gamma', type=float, default=None)
+    parser.add_argument('--warm-start', dest='warm_start_path', default=None)
+    parser.add_argument('--checkpoint', dest='checkpoint_path', default=None)
+    return parser.parse_args()
+
+
+if __name__=='__main__' and len(sys.argv) > 1:
+    # 手番，手法を指定して1つだけ求める（warm start，チェックポイントが使える）
+    args = parse_args()
+    main(args.player_mark, args.plan_type, args.gamma,
+         args.warm_start_path, args.checkpoint_path)
+    print('Completed')
 
-if __name__=='__main__':
+elif __name__=='__main__':
     # Value Iteration
     # 先手番用のVを求める
     print('Calculating V for CIRCLE...')
@@ -0,0 +1,194 @@
+import tic_tac_toe_environment
+import sys
+
+# 盤面コードの桁の重み（マス(r, c)は3^(3r+c)の桁）
+POWERS = [3 ** i for i in range(9)]
+# 盤面コードの総数（3^9通り）
+NUM_CODES = 3 ** 9
+
+# 結果の定義（手番側から見た勝敗）
+UNKNOWN = 0 # 存在しえない盤面
+LOSS = 1 # 手番側の負け
+DRAW = 2 # 引き分け
+WIN = 3 # 手番側の勝ち
+
+RESULT_NAMES = {UNKNOWN: 'unknown', LOSS: 'loss', DRAW: 'draw', WIN: 'win'}
+
+def board_to_code(board):
+    '''
+    盤面を盤面コード（0〜3^9-1の整数）に変換する
+    各マスの値（-1, 0, 1）に1を足したものを3進数の1桁とみなす
+    '''
+    code = 0
+    for i, action in enumerate(tic_tac_toe_environment.Actions):
+        code += (int(board[action.value]) + 1) * POWERS[i]
+    return code
+
+def code_to_cells(code):
+    '''
+    盤面コードを各マスの値（-1, 0, 1）のリストに変換する
+    '''
+    cells = []
+    for _ in range(9):
+        cells.append(code % 3 - 1)
+        code //= 3
+    return cells
+
+def pack(result, distance):
+    '''
+    結果（2bit）と決着までの手数（4bit）を1byteに詰める
+    '''
+    return (result << 4) | distance
+
+def unpack(byte):
+    '''
+    1byteから結果と決着までの手数を取り出す
+    '''
+    return byte >> 4, byte & 0x0F
+
+
+class Tablebase():
+    '''
+    完全読みによる結果表（tablebase）
+    self.table（盤面コードごとに結果と決着までの手数を1byteに詰めたもの）
+    self.best_move_masks（盤面コードごとの最善手のビットマスク。
+                          ビットiはlist(Actions)[i]に対応）
+    '''
+    def __init__(self, table):
+        self.table = bytes(table)
+        self.best_move_masks = self.__build_best_move_masks(self.table)
+
+    @classmethod
+    def generate(cls, env=None):
+        '''
+        Environment.statesの全盤面について後退解析で結果表を生成する
+        '''
+        if env is None:
+            env = tic_tac_toe_environment.Environment(1)
+
+        # 手数の多い盤面から順に確定させる（子の盤面は必ず手数が1多い）
+        states = sorted(env.states, key=lambda s: s.step, reverse=True)
+        table = bytearray(NUM_CODES)
+        for s in states:
+            code = board_to_code(s.board)
+            # 決着盤面：勝った側が手番側なら勝ち，そうでなければ手番側の負け
+            # （手番側が勝っている盤面は実際の対局では現れないが，Statusと矛盾させない）
+            if s.status == tic_tac_toe_environment.Status.DRAW:
+                table[code] = pack(DRAW, 0)
+                continue
+            elif s.status.value == s.turn.value:
+                table[code] = pack(WIN, 0)
+                continue
+            elif s.status != tic_tac_toe_environment.Status.UNDECIDED:
+                table[code] = pack(LOSS, 0)
+                continue
+
+            # 未決着盤面：全ての子の盤面から最善の結果を選ぶ
+            mark = s.turn.value
+            best_key = None
+            best_entry = None
+            for i in range(9):
+                if (code // POWERS[i]) % 3 != 1:
+                    continue
+                child_result, child_distance = unpack(table[code + mark * POWERS[i]])
+                key = cls.__move_key(child_result, child_distance)
+                if best_key is None or key > best_key:
+                    best_key = key
+                    best_entry = pack(cls.__flip(child_result), child_distance + 1)
+            table[code] = best_entry
+
+        return cls(table)
+
+    @staticmethod
+    def __flip(result):
+        '''
+        相手側から見た結果を手番側から見た結果に変換する
+        '''
+        if result == WIN:
+            return LOSS
+        elif result == LOSS:
+            return WIN
+        return result
+
+    @staticmethod
+    def __move_key(child_result, child_distance):
+        '''
+        子の盤面（相手の手番）の結果から，その手の良さを比較するキーを返す
+        勝ちは早いほど，負けは遅いほど良い
+        '''
+        if child_result == LOSS:
+            return (2, -child_distance)
+        elif child_result == DRAW:
+            return (1, 0)
+        else:
+            return (0, child_distance)
+
+    def __build_best_move_masks(self, table):
+        '''
+        各盤面での最善手をビットマスクとして前計算する
+        '''
+        masks = [0] * NUM_CODES
+        for code in range(NUM_CODES):
+            result, distance = unpack(table[code])
+            if result == UNKNOWN or distance == 0:
+                continue
+            # 手番は盤面の〇と×の数から決まる
+            cells = code_to_cells(code)
+            mark = 1 if sum(cells) == 0 else -1
+            for i in range(9):
+                if cells[i] != 0:
+                    continue
+                child_result, child_distance = unpack(table[code + mark * POWERS[i]])
+                if self.__flip(child_result) == result and child_distance + 1 == distance:
+                    masks[code] |= 1 << i
+        return masks
+
+    def probe(self, code):
+        '''
+        盤面コードcodeの（結果, 決着までの手数）を返す
+        '''
+        return unpack(self.table[code])
+
+    def best_moves(self, code):
+        '''
+        盤面コードcodeでの最善手（Actions）の一覧を返す
+        '''
+        mask = self.best_move_masks[code]
+        actions = list(tic_tac_toe_environment.Actions)
+        return [actions[i] for i in range(9) if mask >> i & 1]
+
+    def query(self, code):
+        '''
+        盤面コードcodeの（結果, 決着までの手数, 最善手一覧）を返す
+        '''
+        result, distance = self.probe(code)
+        return result, distance, self.best_moves(code)
+
+    def save(self, path='tablebase.bin'):
+        with open(path, 'wb') as f:
+            f.write(self.table)
+
+    @classmethod
+    def load(cls, path='tablebase.bin'):
+        with open(path, 'rb') as f:
+            table = f.read()
+        if len(table) != NUM_CODES:
+            raise ValueError(f'結果表のサイズが不正です：{len(table)}')
+        return cls(table)
+
+
+def main(path='tablebase.bin'):
+    tablebase = Tablebase.generate()
+    tablebase.save(path)
+
+    # 初期盤面の結果を表示
+    result, distance, moves = tablebase.query(board_to_code(tic_tac_toe_environment.State().board))
+    print(f'initial position: {RESULT_NAMES[result]} in {distance} plies')
+    print(f'best moves: {[a.name for a in moves]}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(sys.argv[1])
+    else:
+        main()